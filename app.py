@@ -3,19 +3,27 @@
 # ========================================
 import streamlit as st
 import pandas as pd
+import numpy as np
 import base64
+import io
 import time
 import re
 import json
 import random
 import os
+import string
+import hashlib
 from datetime import datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
+from email.generator import BytesGenerator
+from email.header import Header
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
 
 # ========================================
 # Streamlit Page Setup
@@ -65,29 +73,65 @@ CLIENT_CONFIG = {
 # Constants
 # ========================================
 DONE_FILE = "/tmp/mailmerge_done.json"
+PROGRESS_FILE = "/tmp/mailmerge_progress_{run_key}.jsonl"  # append-only per-row outcomes, one file per run
 BATCH_SIZE_DEFAULT = 50
 DRAFT_BATCH_SIZE_DEFAULT = 110  # <--- NEW: Draft mode default batch size
+GMAIL_BATCH_OPS = 50  # requests per Gmail /batch HTTP call (API hard limit is 100)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}  # 403 reasons worth retrying
+RETRY_BASE_SECONDS = 1
+RETRY_CAP_SECONDS = 64
+SEND_MAX_ATTEMPTS = 6
+PACING_CAP_SECONDS = 75
+GMAIL_QUOTA_PER_SEC = 250  # Gmail per-user quota units per second
+GMAIL_QUOTA_UNITS = {
+    "gmail.users.messages.send": 100,
+    "gmail.users.drafts.create": 10,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.batchModify": 50,
+    "gmail.users.labels.list": 1,
+    "gmail.users.labels.create": 5,
+    "gmail.users.getProfile": 1,
+}
+UPLOAD_CHUNK_BYTES = 256 * 1024
+CSV_CHUNK_THRESHOLD = 1_000_000  # bytes; larger uploads are parsed in chunks
+CSV_CHUNK_ROWS = 10_000
 
 # ========================================
 # Recovery Logic
 # ========================================
-if os.path.exists(DONE_FILE) and not st.session_state.get("done", False):
+# Bounded so finished-run CSVs don't pile up in process memory
+@st.cache_data(max_entries=4)
+def load_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+# Only touch DONE_FILE on the first run of a session, not on every widget rerun
+if "_done_info" not in st.session_state:
+    st.session_state["_done_info"] = None
+    if os.path.exists(DONE_FILE):
+        try:
+            with open(DONE_FILE, "r") as f:
+                st.session_state["_done_info"] = json.load(f)
+        except Exception:
+            pass
+
+done_info = st.session_state["_done_info"]
+if done_info and not st.session_state.get("done", False):
     try:
-        with open(DONE_FILE, "r") as f:
-            done_info = json.load(f)
         file_path = done_info.get("file")
         if file_path and os.path.exists(file_path):
             st.success("✅ Previous mail merge completed successfully.")
             st.download_button(
                 "⬇️ Download Updated CSV",
-                data=open(file_path, "rb"),
+                data=load_bytes(file_path),
                 file_name=os.path.basename(file_path),
                 mime="text/csv",
             )
             if st.button("🔁 Reset for New Run"):
                 os.remove(DONE_FILE)
                 st.session_state.clear()
-                st.experimental_rerun()
+                st.rerun()
             st.stop()
     except Exception:
         pass
@@ -95,47 +139,258 @@ if os.path.exists(DONE_FILE) and not st.session_state.get("done", False):
 # ========================================
 # Helpers
 # ========================================
-EMAIL_REGEX = re.compile(r"[\w\.-]+@[\w\.-]+\.\w+")
+# Unambiguous local/domain classes and a start-of-token lookbehind keep matching linear
+EMAIL_REGEX = re.compile(r"(?<![\w.+-])[A-Za-z0-9._+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+")
+HELPER_COLUMNS = ["_to"]  # computed per run, never written back to the CSV
+TEXT_COLUMNS = ["Email", "ThreadId", "RfcMessageId", "Status"]
+
+def extract_emails(values: pd.Series) -> pd.Series:
+    return values.astype(str).str.extract(f"({EMAIL_REGEX.pattern})", expand=False)
+
+def read_csv_upload(file_bytes, encoding):
+    # Address/id columns stay text; the rest keeps inference so {Amount:.2f}-style specs still work
+    kwargs = dict(encoding=encoding, dtype=dict.fromkeys(TEXT_COLUMNS, str), engine="c", low_memory=True)
+    if len(file_bytes) > CSV_CHUNK_THRESHOLD:
+        return pd.concat(pd.read_csv(io.BytesIO(file_bytes), chunksize=CSV_CHUNK_ROWS, **kwargs), ignore_index=True)
+    return pd.read_csv(io.BytesIO(file_bytes), **kwargs)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_df(file_bytes, name):
+    # --- FIX: Safe CSV reading with encoding fallback ---
+    if name.lower().endswith("csv"):
+        try:
+            df = read_csv_upload(file_bytes, "utf-8")
+        except UnicodeDecodeError:
+            df = read_csv_upload(file_bytes, "latin1")
+    else:
+        df = pd.read_excel(io.BytesIO(file_bytes))
+    for col in ["ThreadId", "RfcMessageId", "Status"]:
+        if col not in df.columns:
+            df[col] = ""
+    return df
+
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def render_preview(subject_template, body_template, row_items):
+    row = dict(row_items)
+    return subject_template.format_map(row), convert_bold(body_template.format_map(row))
+
+def merge_run_key(account, file_bytes, send_mode, subject_template, body_template):
+    # Same mailbox, same uploaded file, same templates and mode: only then is it the same merge
+    key = hashlib.sha1(file_bytes)
+    key.update(f"\0{account}\0{send_mode}\0{subject_template}\0{body_template}".encode())
+    return key.hexdigest()[:12]
+
+def replay_progress(df, run_key):
+    # Re-apply Sent/Draft outcomes logged by an interrupted run of the same merge
+    path = PROGRESS_FILE.format(run_key=run_key)
+    if not os.path.exists(path):
+        return df
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            idx = entry.get("idx")
+            if entry.get("run") != run_key or entry.get("Status") not in ("Sent", "Draft"):
+                continue
+            if not isinstance(idx, int) or not 0 <= idx < len(df):
+                continue
+            to_addr = df.at[idx, "_to"]
+            if pd.isna(to_addr) or to_addr != entry.get("to"):
+                continue
+            for col in ("ThreadId", "RfcMessageId", "Status"):
+                if col in entry:
+                    df.at[idx, col] = entry[col]
+    return df
+
+def header_value(value):
+    # One line only (no header injection); RFC 2047 encode anything non-ASCII
+    value = " ".join(str(value).splitlines())
+    return value if value.isascii() else Header(value, "utf-8").encode()
+
+# Every message shares this header block; only To/Subject (and reply headers) vary per row
+MIME_HTML_HEADERS = (
+    'Content-Type: text/html; charset="utf-8"\n'
+    "MIME-Version: 1.0\n"
+    "Content-Transfer-Encoding: base64\n\n"
+).encode("ascii")
+
+def build_raw_message(to_addr, subject, body_html, extra_headers=""):
+    # Same wire format MIMEText(body_html, "html") produces for UTF-8, without the email package
+    head = f"To: {to_addr}\nSubject: {header_value(subject)}\n{extra_headers}"
+    raw = head.encode("ascii") + MIME_HTML_HEADERS + base64.encodebytes(body_html.encode("utf-8"))
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def template_fields(template):
+    try:
+        return {re.split(r"[.\[]", field)[0] for _, field, _, _ in string.Formatter().parse(template) if field}
+    except ValueError:
+        return set()
 
-def extract_email(value: str):
-    if not value:
+def compile_template(template):
+    # Pre-parse into (literal, field, spec, conversion) once; None means "needs str.format_map"
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError:
         return None
-    match = EMAIL_REGEX.search(str(value))
-    return match.group(0) if match else None
+    for _, field, spec, _ in parsed:
+        if field is not None and (not field or field.isdigit() or "." in field or "[" in field or "{" in spec):
+            return None
+    return parsed
+
+def render_template(template, parsed, columns, idx):
+    if parsed is None:
+        return template.format_map({name: col[idx] for name, col in columns.items()})
+    parts = []
+    for literal, field, spec, conversion in parsed:
+        parts.append(literal)
+        if field is not None:
+            value = columns[field][idx]
+            if conversion == "r":
+                value = repr(value)
+            elif conversion == "a":
+                value = ascii(value)
+            elif conversion == "s":
+                value = str(value)
+            parts.append(format(value, spec))
+    return "".join(parts)
+
+BOLD_PATTERN = r"\*\*(.*?)\*\*"
+LINK_PATTERN = r"\[(.*?)\]\((https?://[^\s)]+)\)"
+LINK_REPLACEMENT = r'<a href="\2" style="color:#1a73e8; text-decoration:underline;" target="_blank">\1</a>'
+HTML_PREFIX = """
+    <html><body style="font-family: 'Google Sans', Arial, sans-serif; font-size: 14px; line-height: 1.6;">
+        """
+HTML_SUFFIX = """
+    </body></html>
+    """
+
+BOLD_RE = re.compile(BOLD_PATTERN)
+LINK_RE = re.compile(LINK_PATTERN)
+# Values containing any of these could change what the markdown rules match once merged;
+# empty values count too, since they join the literals on either side (e.g. "*{Title}*")
+MARKDOWN_SENSITIVE = r"[*\[\]()\n]|  |^\s|\s$|^$"
 
 def convert_bold(text):
     if not text:
         return ""
-    text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text)
-    text = re.sub(
-        r"\[(.*?)\]\((https?://[^\s)]+)\)",
-        r'<a href="\2" style="color:#1a73e8; text-decoration:underline;" target="_blank">\1</a>',
-        text,
-    )
+    text = BOLD_RE.sub(r"<b>\1</b>", text)
+    text = LINK_RE.sub(LINK_REPLACEMENT, text)
     text = text.replace("\n", "<br>").replace("  ", "&nbsp;&nbsp;")
-    return f"""
-    <html><body style="font-family: 'Google Sans', Arial, sans-serif; font-size: 14px; line-height: 1.6;">
-        {text}
-    </body></html>
-    """
+    return HTML_PREFIX + text + HTML_SUFFIX
+
+def convert_bold_series(texts: pd.Series) -> pd.Series:
+    html = (
+        texts.str.replace(BOLD_RE, r"<b>\1</b>", regex=True)
+        .str.replace(LINK_RE, LINK_REPLACEMENT, regex=True)
+        .str.replace("\n", "<br>", regex=False)
+        .str.replace("  ", "&nbsp;&nbsp;", regex=False)
+    )
+    return (HTML_PREFIX + html + HTML_SUFFIX).where(texts != "", "")
+
+def convert_template(template, parsed):
+    # Markdown -> HTML on the template itself, so rows only need formatting; None = convert per row
+    if parsed is None or not "".join(literal for literal, _, _, _ in parsed).strip():
+        return None
+    if any(field is not None and (spec or conversion) for _, field, spec, conversion in parsed):
+        return None
+    if any("{" in m.group(2) for m in LINK_RE.finditer(template)):
+        return None
+    html = convert_bold(template)
+    return None if "](" in html else html
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_sec):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_sec)
+        self.updated = now
+
+    def consume(self, cost):
+        # Large calls overdraw the bucket and the next call waits: caps the average rate, not bursts
+        self._refill()
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.refill_per_sec)
+            self._refill()
+        self.tokens -= cost
+
+gmail_quota = TokenBucket(GMAIL_QUOTA_PER_SEC, GMAIL_QUOTA_PER_SEC)
+
+def quota_cost(request):
+    return GMAIL_QUOTA_UNITS.get(getattr(request, "methodId", None), 5)
+
+def error_reasons(error):
+    # Structured reason codes from the error body, e.g. {"reason": "userRateLimitExceeded"}
+    details = getattr(error, "error_details", None)
+    if not isinstance(details, list):
+        return set()
+    return {d.get("reason") for d in details if isinstance(d, dict)}
+
+def is_retryable(error):
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status in RETRY_STATUSES:
+        return True
+    # Per-second/per-user rate limits clear up; dailyLimitExceeded and other 403s do not
+    return error.resp.status == 403 and bool(error_reasons(error) & RATE_LIMIT_REASONS)
+
+def backoff_sleep(attempt, error=None):
+    # Honour the server's Retry-After when it sends one
+    retry_after = error.resp.get("retry-after", "") if isinstance(error, HttpError) else ""
+    if retry_after.isdigit():
+        time.sleep(int(retry_after))
+        return
+    # Full jitter: anywhere between 0 and the capped exponential step
+    time.sleep(random.uniform(0, min(RETRY_CAP_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt)))
+
+def call_with_retry(request, max_attempts=SEND_MAX_ATTEMPTS):
+    for attempt in range(max_attempts):
+        try:
+            gmail_quota.consume(quota_cost(request))
+            return request.execute()
+        except HttpError as e:
+            if not is_retryable(e) or attempt == max_attempts - 1:
+                raise
+            backoff_sleep(attempt, e)
 
 def get_or_create_label(service, label_name="Mail Merge Sent"):
     try:
-        labels = service.users().labels().list(userId="me").execute().get("labels", [])
-        for label in labels:
-            if label["name"].lower() == label_name.lower():
-                return label["id"]
-        created_label = service.users().labels().create(
+        # Lowercased name -> id for the whole mailbox, fetched once per session
+        label_index = st.session_state.get("label_index")
+        if label_index is None:
+            resp = call_with_retry(service.users().labels().list(userId="me", fields="labels(id,name)"))
+            label_index = {label["name"].lower(): label["id"] for label in resp.get("labels", [])}
+            st.session_state["label_index"] = label_index
+        if label_name.lower() in label_index:
+            return label_index[label_name.lower()]
+        created_label = call_with_retry(service.users().labels().create(
             userId="me",
             body={"name": label_name, "labelListVisibility": "labelShow", "messageListVisibility": "show"},
-        ).execute()
+        ))
+        label_index[label_name.lower()] = created_label["id"]
         return created_label["id"]
     except Exception:
         return None
 
+def account_email(service):
+    # The signed-in address, looked up once per session; "" if the lookup fails
+    if "account_email" not in st.session_state:
+        try:
+            profile = call_with_retry(service.users().getProfile(userId="me"))
+        except Exception:
+            return ""
+        st.session_state["account_email"] = profile["emailAddress"]
+    return st.session_state["account_email"]
+
 def send_email_backup(service, csv_path):
     try:
-        user_email = service.users().getProfile(userId="me").execute()["emailAddress"]
+        user_email = call_with_retry(service.users().getProfile(userId="me"))["emailAddress"]
         msg = MIMEMultipart()
         msg["To"] = user_email
         msg["From"] = user_email
@@ -145,26 +400,52 @@ def send_email_backup(service, csv_path):
             part = MIMEApplication(f.read(), Name=os.path.basename(csv_path))
         part["Content-Disposition"] = f'attachment; filename="{os.path.basename(csv_path)}"'
         msg.attach(part)
-        raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-        service.users().messages().send(userId="me", body={"raw": raw}).execute()
+        # Spool the message to disk and upload it in chunks instead of a base64 "raw" JSON field
+        eml_path = os.path.splitext(csv_path)[0] + ".eml"
+        with open(eml_path, "wb") as f:
+            BytesGenerator(f).flatten(msg)
+        try:
+            media = MediaFileUpload(eml_path, mimetype="message/rfc822", chunksize=UPLOAD_CHUNK_BYTES, resumable=True)
+            call_with_retry(service.users().messages().send(userId="me", media_body=media))
+        finally:
+            os.remove(eml_path)
         st.info(f"📧 Backup CSV emailed to {user_email}")
     except Exception as e:
         st.warning(f"⚠️ Could not send backup email: {e}")
 
-def fetch_message_id_header(service, message_id):
-    for _ in range(6):
-        try:
-            msg_detail = service.users().messages().get(
-                userId="me", id=message_id, format="metadata", metadataHeaders=["Message-ID"]
-            ).execute()
-            headers = msg_detail.get("payload", {}).get("headers", [])
-            for h in headers:
-                if h.get("name", "").lower() == "message-id":
-                    return h.get("value")
-        except Exception:
-            pass
-        time.sleep(random.uniform(1, 2))
-    return ""
+def fetch_message_id_headers(service, message_ids, max_attempts=3):
+    # Batched metadata GETs; ids whose header isn't indexed yet are asked again after a backoff
+    found = {}
+
+    def on_metadata(request_id, response, exception):
+        if exception is not None:
+            return
+        for h in response.get("payload", {}).get("headers", []):
+            if h.get("name", "").lower() == "message-id":
+                found[request_id] = h.get("value")
+
+    remaining = list(message_ids)
+    for attempt in range(max_attempts):
+        if attempt:
+            backoff_sleep(attempt - 1)
+        for start in range(0, len(remaining), GMAIL_BATCH_OPS):
+            chunk = remaining[start:start + GMAIL_BATCH_OPS]
+            batch, cost = service.new_batch_http_request(callback=on_metadata), 0
+            for msg_id in chunk:
+                request = service.users().messages().get(
+                    userId="me", id=msg_id, format="metadata", metadataHeaders=["Message-ID"], fields="payload/headers"
+                )
+                batch.add(request, request_id=msg_id)
+                cost += quota_cost(request)
+            try:
+                gmail_quota.consume(cost)
+                batch.execute()
+            except Exception:
+                pass
+        remaining = [m for m in remaining if m not in found]
+        if not remaining:
+            break
+    return found
 
 # ========================================
 # OAuth Flow
@@ -172,14 +453,12 @@ def fetch_message_id_header(service, message_id):
 if "creds" not in st.session_state:
     st.session_state["creds"] = None
 
-if st.session_state["creds"]:
-    creds = Credentials.from_authorized_user_info(json.loads(st.session_state["creds"]), SCOPES)
-else:
-    code = st.experimental_get_query_params().get("code", None)
+if not st.session_state["creds"]:
+    code = st.query_params.get("code")
     if code:
         flow = Flow.from_client_config(CLIENT_CONFIG, scopes=SCOPES)
         flow.redirect_uri = st.secrets["gmail"]["redirect_uri"]
-        flow.fetch_token(code=code[0])
+        flow.fetch_token(code=code)
         creds = flow.credentials
         st.session_state["creds"] = creds.to_json()
         st.rerun()
@@ -190,8 +469,13 @@ else:
         st.markdown(f"### 🔑 Please [authorize the app]({auth_url}) to send emails using your Gmail account.")
         st.stop()
 
-creds = Credentials.from_authorized_user_info(json.loads(st.session_state["creds"]), SCOPES)
-service = build("gmail", "v1", credentials=creds)
+# Deserialize credentials and build the Gmail client once per session; reruns reuse it
+if "service" not in st.session_state:
+    creds = Credentials.from_authorized_user_info(json.loads(st.session_state["creds"]), SCOPES)
+    st.session_state["service"] = build(
+        "gmail", "v1", credentials=creds, cache_discovery=False, static_discovery=True
+    )
+service = st.session_state["service"]
 
 # ========================================
 # Session Setup
@@ -210,24 +494,12 @@ if not st.session_state["sending"]:
     uploaded_file = st.file_uploader("Upload CSV or Excel file", type=["csv", "xlsx"])
 
     if uploaded_file:
-        # --- FIX: Safe CSV reading with encoding fallback ---
-        if uploaded_file.name.lower().endswith("csv"):
-            try:
-                df = pd.read_csv(uploaded_file, encoding="utf-8")
-            except UnicodeDecodeError:
-                try:
-                    uploaded_file.seek(0)
-                    df = pd.read_csv(uploaded_file, encoding="latin1")
-                except Exception:
-                    st.error("⚠️ Unable to read the uploaded CSV. Please check that it's a valid CSV file.")
-                    st.stop()
-        else:
-            df = pd.read_excel(uploaded_file)
-        # -----------------------------------------------------
-
-        for col in ["ThreadId", "RfcMessageId", "Status"]:
-            if col not in df.columns:
-                df[col] = ""
+        # Parsed once per distinct file; widget reruns hit the cache
+        try:
+            df = load_df(uploaded_file.getvalue(), uploaded_file.name)
+        except Exception:
+            st.error("⚠️ Unable to read the uploaded file. Please check that it's a valid CSV or Excel file.")
+            st.stop()
 
         st.info("📌 Tip: Include 'ThreadId' and 'RfcMessageId' for follow-ups if available.")
         st.markdown("### ✏️ Edit Your Contact List")
@@ -249,14 +521,28 @@ Thanks,
         )
 
         label_name = st.text_input("🏷️ Gmail label", "Mail Merge Sent")
-        delay = st.slider("⏱️ Delay between emails (seconds)", 20, 75, 20)
+        delay = st.slider("⏱️ Max delay between sends (seconds, 0 = quota-limited only)", 0, 75, 20)
+        pacing = st.radio("🐢 Apply delay", ["Per batch", "Per message"], horizontal=True)
         send_mode = st.radio("📬 Choose send mode", ["🆕 New Email", "↩️ Follow-up (Reply)", "💾 Save as Draft"])
 
+        # Saved progress is per run: only this account + file + templates + mode resumes from it
+        run_key = merge_run_key(
+            account_email(service), uploaded_file.getvalue(), send_mode, subject_template, body_template
+        )
+        progress_path = PROGRESS_FILE.format(run_key=run_key)
+        if os.path.exists(progress_path):
+            st.warning(
+                "⏸️ This mail merge was interrupted earlier. Starting it again resumes it — rows it already "
+                "sent or drafted will be skipped."
+            )
+            if st.button("🗑️ Discard saved progress"):
+                os.remove(progress_path)
+                st.rerun()
+
         if not df.empty:
-            preview_row = df.iloc[0]
+            preview_row = tuple(zip(df.columns, next(df.itertuples(index=False, name=None))))
             try:
-                preview_subject = subject_template.format(**preview_row)
-                preview_body = convert_bold(body_template.format(**preview_row))
+                preview_subject, preview_body = render_preview(subject_template, body_template, preview_row)
             except Exception as e:
                 preview_subject = subject_template
                 preview_body = body_template
@@ -270,8 +556,17 @@ Thanks,
         if st.button("🚀 Start Mail Merge"):
             df = df.reset_index(drop=True)
             df = df.fillna("")
+            missing = sorted((template_fields(subject_template) | template_fields(body_template)) - set(df.columns))
+            if missing:
+                st.error(f"⚠️ Template uses columns that are not in your sheet: {', '.join(missing)}")
+                st.stop()
+            if "Email" in df.columns:
+                df["_to"] = extract_emails(df["Email"])
+            else:
+                df["_to"] = pd.Series(pd.NA, index=df.index, dtype=object)
 
-            pending_indices = df.index[~df["Status"].isin(["Sent", "Draft"])].tolist()
+            df = replay_progress(df, run_key)
+            pending_indices = np.flatnonzero(~df["Status"].isin(["Sent", "Draft"]).to_numpy())
 
             st.session_state.update({
                 "sending": True,
@@ -281,21 +576,28 @@ Thanks,
                 "body_template": body_template,
                 "label_name": label_name,
                 "delay": delay,
-                "send_mode": send_mode
+                "pacing": pacing,
+                "send_mode": send_mode,
+                "run_key": run_key,
             })
             st.rerun()
 
 # ========================================
 # Sending Mode with Progress
 # ========================================
-if st.session_state["sending"]:
+# Runs as part of the full app run that starts the merge (it has no widgets of its own);
+# the st.rerun() at the end reruns the whole app to show the summary
+@st.fragment
+def send_fragment():
     df = st.session_state["df"]
     pending_indices = st.session_state["pending_indices"]
     subject_template = st.session_state["subject_template"]
     body_template = st.session_state["body_template"]
     label_name = st.session_state["label_name"]
     delay = st.session_state["delay"]
+    pacing = st.session_state["pacing"]
     send_mode = st.session_state["send_mode"]
+    run_key = st.session_state["run_key"]
 
     st.subheader("📨 Sending Emails...")
     progress = st.progress(0)
@@ -305,88 +607,243 @@ if st.session_state["sending"]:
     if send_mode == "🆕 New Email":
         label_id = get_or_create_label(service, label_name)
 
-    total = len(pending_indices)
-    sent_count, skipped, errors = 0, [], []
+    sent_count, errors = 0, []
     batch_count = 0
-    sent_message_ids = []
-
-    for i, idx in enumerate(pending_indices):
-        # NEW: Draft mode gets batch limit 110
-        batch_limit = DRAFT_BATCH_SIZE_DEFAULT if send_mode == "💾 Save as Draft" else BATCH_SIZE_DEFAULT
-        if batch_count >= batch_limit:
-            break
-
-        row = df.loc[idx]
 
-        pct = int(((i + 1) / total) * 100)
-        progress.progress(min(max(pct, 0), 100))
-        status_box.info(f"📩 Processing {i + 1}/{total}")
-
-        to_addr = extract_email(str(row.get("Email", "")).strip())
-        if not to_addr:
-            skipped.append(row.get("Email"))
-            df.loc[idx, "Status"] = "Skipped"
-            continue
-
-        try:
-            subject = subject_template.format(**row)
-            body_html = convert_bold(body_template.format(**row))
-            message = MIMEText(body_html, "html")
-            message["To"] = to_addr
-            message["Subject"] = subject
-
-            msg_body = {}
-            if send_mode == "↩️ Follow-up (Reply)":
-                thread_id = str(row.get("ThreadId", "")).strip()
-                rfc_id = str(row.get("RfcMessageId", "")).strip()
-                if thread_id and rfc_id:
-                    message["In-Reply-To"] = rfc_id
-                    message["References"] = rfc_id
-                    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-                    msg_body = {"raw": raw, "threadId": thread_id}
-                else:
-                    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-                    msg_body = {"raw": raw}
+    # Sends/drafts go through Gmail's /batch endpoint, GMAIL_BATCH_OPS per HTTP call
+    queued, retry_errors = {}, {}
+    just_sent = []
+    # Outcome columns as plain positional lists, assigned back to df once after the loop
+    outcome = {c: df[c].tolist() for c in ("ThreadId", "RfcMessageId", "Status")}
+
+    def record_result(idx, to_addr, **cols):
+        for col, value in cols.items():
+            outcome[col][idx] = value
+        to_value = None if pd.isna(to_addr) else to_addr
+        progress_log.write(json.dumps({"run": run_key, "idx": int(idx), "to": to_value, **cols}) + "\n")
+
+    def record_error(request_id, exception):
+        idx = int(request_id)
+        to_addr, _ = queued.pop(request_id)
+        record_result(idx, to_addr, Status="Error")
+        errors.append((to_addr, str(exception)))
+        st.error(f"❌ Error for {to_addr}: {exception}")
+
+    def on_response(request_id, response, exception):
+        nonlocal sent_count, batch_count
+        if exception is not None:
+            if is_retryable(exception):
+                retry_errors[request_id] = exception
             else:
-                raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-                msg_body = {"raw": raw}
+                record_error(request_id, exception)
+            return
+        idx = int(request_id)
+        to_addr, _ = queued.pop(request_id)
+        if send_mode == "💾 Save as Draft":
+            record_result(idx, to_addr, Status="Draft")
+        else:
+            # The RFC Message-ID is filled in by resolve_message_ids after the batch
+            msg_id = response.get("id", "")
+            record_result(idx, to_addr, ThreadId=response.get("threadId", ""), RfcMessageId=msg_id, Status="Sent")
+            just_sent.append((idx, msg_id))
+        # Progress and the batch limit only move once Gmail has accepted the message
+        sent_count += 1
+        batch_count += 1
+        progress.progress(min(int(sent_count / total * 100), 100))
+        status_box.info(f"📩 Processed {sent_count}/{total}")
+
+    def send_queued():
+        # Sequential on purpose: the quota bucket, not latency, bounds throughput; httplib2 isn't thread-safe
+        # Rate-limited / 5xx requests are resubmitted with backoff; anything else fails the row
+        for attempt in range(SEND_MAX_ATTEMPTS):
+            if attempt:
+                backoff_sleep(attempt - 1, next(iter(retry_errors.values()), None))
+            retry_errors.clear()
+            batch, cost = service.new_batch_http_request(callback=on_response), 0
+            for request_id, (_, msg_body) in queued.items():
+                request = submit(msg_body)
+                batch.add(request, request_id=request_id)
+                cost += quota_cost(request)
+            try:
+                gmail_quota.consume(cost)
+                batch.execute()
+            except Exception as e:
+                if not is_retryable(e):
+                    for request_id in list(queued):
+                        record_error(request_id, e)
+                    return
+                retry_errors.update(dict.fromkeys(queued, e))
+            if not queued:
+                return
+        for request_id in list(queued):
+            record_error(request_id, retry_errors[request_id])
+
+    def resolve_message_ids():
+        headers = fetch_message_id_headers(service, [msg_id for _, msg_id in just_sent])
+        for idx, msg_id in just_sent:
+            if msg_id in headers:
+                record_result(
+                    idx, to_arr[idx], ThreadId=outcome["ThreadId"][idx], RfcMessageId=headers[msg_id], Status="Sent"
+                )
+
+    def apply_label():
+        # messages.send ignores labelIds in the request body (only insert/import honour them),
+        # so the label goes on with one batchModify per batch rather than per message
+        try:
+            call_with_retry(service.users().messages().batchModify(
+                userId="me",
+                body={"ids": [msg_id for _, msg_id in just_sent], "addLabelIds": [label_id]}
+            ))
+        except Exception as e:
+            st.warning(f"⚠️ Labeling failed: {e}")
+
+    def flush_batch():
+        # Per batch: one /batch call for the sends, one for their Message-IDs, one batchModify for the label
+        send_queued()
+        if just_sent:
+            resolve_message_ids()
+            if label_id:
+                apply_label()
+            just_sent.clear()
+
+    # Column arrays for the fields the loop reads, indexed by row position
+    to_arr = df["_to"].to_numpy()
+    email_arr = df["Email"].to_numpy() if "Email" in df.columns else np.full(len(df), None, dtype=object)
+    # Ids that round-tripped through a spreadsheet as "nan"/"None" count as missing
+    tid_ser = df["ThreadId"].astype(str).str.strip()
+    rfc_ser = df["RfcMessageId"].astype(str).str.strip()
+    tid_arr = tid_ser.to_numpy()
+    rfc_arr = rfc_ser.to_numpy()
+    has_reply_ids = (
+        tid_ser.ne("") & ~tid_ser.str.lower().isin(["nan", "none"])
+        & rfc_ser.ne("") & ~rfc_ser.str.lower().isin(["nan", "none"])
+    ).to_numpy()
+
+    # Rows without a usable address are skipped up front, so the loop is pure dispatch
+    has_addr = ~pd.isna(to_arr[pending_indices])
+    skipped_rows = pending_indices[~has_addr]
+    pending_indices = pending_indices[has_addr]
+
+    # One message per normalized address (per thread for follow-ups that really reply); the
+    # first row wins, including rows already sent in an earlier run
+    recipient_key = pd.Series(to_arr, dtype=object).str.lower()
+    if send_mode == "↩️ Follow-up (Reply)":
+        recipient_key = (recipient_key + "\0" + tid_ser).where(has_reply_ids, recipient_key)
+    is_dup = (recipient_key.duplicated() & recipient_key.notna()).to_numpy()
+    duplicate_rows = pending_indices[is_dup[pending_indices]]
+    pending_indices = pending_indices[~is_dup[pending_indices]]
+    total = len(pending_indices)
 
-            if send_mode == "💾 Save as Draft":
-                service.users().drafts().create(userId="me", body={"message": msg_body}).execute()
-                df.loc[idx, "Status"] = "Draft"
+    # Parse the templates once and render from plain column lists of the referenced fields only
+    fields = template_fields(subject_template) | template_fields(body_template)
+    columns = {c: df[c].tolist() for c in df.columns if c in fields}
+    subject_parts = compile_template(subject_template)
+    body_parts = compile_template(body_template)
+
+    # Markdown -> HTML once on the body template; rows whose values could interact with the
+    # markdown rules are rendered plain and converted together in one vectorized pass
+    html_template = convert_template(body_template, body_parts)
+    html_parts = compile_template(html_template) if html_template is not None else None
+    needs_convert = np.ones(len(df), dtype=bool)
+    if html_template is not None:
+        needs_convert[:] = False
+        for c in template_fields(body_template) & columns.keys():
+            needs_convert |= df[c].astype(str).str.contains(MARKDOWN_SENSITIVE, regex=True).to_numpy()
+
+    # Render every pending row up front
+    subjects, bodies, filled, render_errors = {}, {}, {}, {}
+    for idx in pending_indices:
+        try:
+            subjects[idx] = render_template(subject_template, subject_parts, columns, idx)
+            if needs_convert[idx]:
+                filled[idx] = render_template(body_template, body_parts, columns, idx)
             else:
-                sent_msg = service.users().messages().send(userId="me", body=msg_body).execute()
-                msg_id = sent_msg.get("id", "")
-                df.loc[idx, "ThreadId"] = sent_msg.get("threadId", "")
-                df.loc[idx, "RfcMessageId"] = fetch_message_id_header(service, msg_id) or msg_id
-                df.loc[idx, "Status"] = "Sent"
-                if send_mode == "🆕 New Email" and label_id:
-                    sent_message_ids.append(msg_id)
-
-            time.sleep(random.uniform(delay * 0.9, delay * 1.1))
-            sent_count += 1
-            batch_count += 1
+                bodies[idx] = render_template(html_template, html_parts, columns, idx)
         except Exception as e:
-            df.loc[idx, "Status"] = "Error"
-            errors.append((to_addr, str(e)))
-            st.error(f"❌ Error for {to_addr}: {e}")
+            render_errors[idx] = e
+    bodies.update(convert_bold_series(pd.Series(filled, dtype=object)).to_dict())
+
+    # NEW: Draft mode gets batch limit 110
+    batch_limit = DRAFT_BATCH_SIZE_DEFAULT if send_mode == "💾 Save as Draft" else BATCH_SIZE_DEFAULT
+
+    # send_mode is fixed for the run: pick the body builder and submit call once
+    def build_plain(idx, subject, body_html):
+        return {"raw": build_raw_message(to_arr[idx], subject, body_html)}
+
+    def build_followup(idx, subject, body_html):
+        if not has_reply_ids[idx]:
+            return build_plain(idx, subject, body_html)
+        rfc_id = header_value(rfc_arr[idx])
+        raw = build_raw_message(to_arr[idx], subject, body_html, f"In-Reply-To: {rfc_id}\nReferences: {rfc_id}\n")
+        return {"raw": raw, "threadId": tid_arr[idx]}
+
+    # messages.send never returns headers, whatever the projection; trim the response to what
+    # is used and leave the Message-ID to the batched metadata lookup
+    def submit_draft(msg_body):
+        return service.users().drafts().create(userId="me", body={"message": msg_body}, fields="id")
+
+    def submit_send(msg_body):
+        return service.users().messages().send(userId="me", body=msg_body, fields="id,threadId")
+
+    build_body = build_followup if send_mode == "↩️ Follow-up (Reply)" else build_plain
+    submit = submit_draft if send_mode == "💾 Save as Draft" else submit_send
+
+    # "Per message" keeps the old one-send-then-wait rhythm for deliverability-sensitive runs
+    ops_per_flush = 1 if pacing == "Per message" else GMAIL_BATCH_OPS
+
+    progress_path = PROGRESS_FILE.format(run_key=run_key)
+    with open(progress_path, "a", buffering=1) as progress_log:
+        skipped = [email_arr[idx] for idx in skipped_rows]
+        for idx in skipped_rows:
+            record_result(idx, None, Status="Skipped")
+        duplicates = [email_arr[idx] for idx in duplicate_rows]
+        for idx in duplicate_rows:
+            record_result(idx, to_arr[idx], Status="Duplicate")
+
+        for i, idx in enumerate(pending_indices):
+            # Rows still in flight may succeed, so settle them before queuing past the limit
+            if batch_count + len(queued) >= batch_limit:
+                if queued:
+                    flush_batch()
+                if batch_count >= batch_limit:
+                    break
+
+            to_addr = to_arr[idx]
 
-    # Label + Backup
-    if send_mode != "💾 Save as Draft":
-        if sent_message_ids and label_id:
             try:
-                service.users().messages().batchModify(
-                    userId="me",
-                    body={"ids": sent_message_ids, "addLabelIds": [label_id]}
-                ).execute()
+                if idx in render_errors:
+                    raise render_errors[idx]
+                msg_body = build_body(idx, subjects[idx], bodies[idx])
             except Exception as e:
-                st.warning(f"⚠️ Labeling failed: {e}")
+                record_result(idx, to_addr, Status="Error")
+                errors.append((to_addr, str(e)))
+                st.error(f"❌ Error for {to_addr}: {e}")
+                continue
+
+            queued[str(idx)] = (to_addr, msg_body)
+
+            if len(queued) >= ops_per_flush:
+                flush_batch()
+                if delay and batch_count < batch_limit and i + 1 < total:
+                    if pacing == "Per message":
+                        # Steady human-like gap of roughly `delay` between sends
+                        time.sleep(random.uniform(delay * 0.9, delay * 1.1))
+                    else:
+                        # Full-jitter pacing between batches, capped
+                        time.sleep(random.uniform(0, min(PACING_CAP_SECONDS, delay)))
+
+        if queued:
+            flush_batch()
+
+    for col, values in outcome.items():
+        df[col] = values
 
     # Save updated CSV & backup email
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     safe_label = re.sub(r'[^A-Za-z0-9_-]', '_', label_name)
     file_name = f"Updated_{safe_label}_{timestamp}.csv"
     file_path = os.path.join("/tmp", file_name)
+    df = df.drop(columns=HELPER_COLUMNS, errors="ignore")
     df.to_csv(file_path, index=False)
     try:
         send_email_backup(service, file_path)
@@ -396,14 +853,18 @@ if st.session_state["sending"]:
     try:
         with open(DONE_FILE, "w") as f:
             json.dump({"done_time": str(datetime.now()), "file": file_path}, f)
+        os.remove(progress_path)
     except Exception:
         pass
 
     st.session_state["sending"] = False
     st.session_state["done"] = True
-    st.session_state["summary"] = {"sent": sent_count, "errors": errors, "skipped": skipped}
+    st.session_state["summary"] = {"sent": sent_count, "errors": errors, "skipped": skipped, "duplicates": duplicates}
     st.rerun()
 
+if st.session_state["sending"]:
+    send_fragment()
+
 # ========================================
 # Completion Summary
 # ========================================
@@ -415,8 +876,10 @@ if st.session_state["done"]:
         st.error(f"❌ {len(summary['errors'])} errors occurred.")
     if summary.get("skipped"):
         st.warning(f"⚠️ Skipped: {summary['skipped']}")
+    if summary.get("duplicates"):
+        st.warning(f"⚠️ Not sent again (duplicate address): {summary['duplicates']}")
     if st.button("🔁 New Run / Reset"):
         if os.path.exists(DONE_FILE):
             os.remove(DONE_FILE)
         st.session_state.clear()
-        st.experimental_rerun()
+        st.rerun()